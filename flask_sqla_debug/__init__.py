@@ -22,7 +22,7 @@ from flask import request
 log = logging.getLogger(__name__)
 
 
-class FlaskSqlaDebugException(Exception):
+class FlaskSqlaDebugException(Exception):  # noqa: N818
     """Generic exception for now.  Might attach more detailed information later."""
 
     pass
@@ -58,10 +58,6 @@ class FlaskSqlaDebug(object):
         self.last_stack_dump = round(time.time())
         self.global_stack_dumps = 0
 
-        # for more fine grained mock patching for unit tests, this lets us simulate longer running queries.
-        self.before_cursor_execute_time = time.time
-        self.after_cursor_execute_time = time.time
-
         if "app" not in kwargs:
             raise ValueError("missing 'app' kwargs, needs to be your flask app")
         self.app = kwargs["app"]
@@ -217,7 +213,7 @@ class FlaskSqlaDebug(object):
         if g is None:
             return
 
-        g["query_start_time"] = self.before_cursor_execute_time()
+        g["query_start_time"] = time.time()
         # If not dumping queries, we are done here.
         if g["dump_queries"] > 0:
             self.log.debug("Executing query: %s, params: %s", statement, parameters)
@@ -237,7 +233,7 @@ class FlaskSqlaDebug(object):
         if g is None:
             return
 
-        time_taken = self.after_cursor_execute_time() - g["query_start_time"]
+        time_taken = time.time() - g["query_start_time"]
 
         # log.debug("Total time: %0.3f, query_count: %d, stacks_dumped: %d", time_taken, g["sql_query_count"], g["stack_dump_count"])
 
@@ -263,7 +259,7 @@ class FlaskSqlaDebug(object):
             logged = True
 
         if g["dump_queries"] > 0:
-            self.log.debug("Query finished in {} seconds.".format(time_taken))
+            self.log.debug("Query finished in %s seconds.", time_taken)
 
 
 FlaskSqlaDebug._make_g_accessor("sql_max_query_count", "Max sql queries per request")
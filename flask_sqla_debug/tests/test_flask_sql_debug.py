@@ -3,11 +3,18 @@
 Do NOT introduce any dependencies outside of the FlaskSqlaDebug module as this
 will be released as a standalone module soon.
 """
+import contextlib
+import functools
+import itertools
 import unittest
+from unittest import mock
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
 import logging
+import os
 import time
 from datetime import datetime
 
@@ -16,17 +23,53 @@ from .. import FlaskSqlaDebug
 
 log = logging.getLogger(__name__)
 
-logging.basicConfig(level=logging.DEBUG)
+# Set TEST_LOG_LEVEL=DEBUG to see the debug output from the tests.
+# Set on our logger directly, under pytest the root logger is already configured and basicConfig is a no-op.
+# Accepts a level name in any case or a numeric level.
+TEST_LOG_LEVEL = os.environ.get('TEST_LOG_LEVEL', 'WARNING').upper()
+if TEST_LOG_LEVEL.isdigit():
+    TEST_LOG_LEVEL = int(TEST_LOG_LEVEL)
+logging.basicConfig(level=TEST_LOG_LEVEL)
+log.setLevel(TEST_LOG_LEVEL)
+if 'TEST_LOG_LEVEL' not in os.environ:
+    # Nobody is listening, have the test logger return before building any records.
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    log.disabled = True
+
+# Set PYTEST_VERBOSE to run each query of the time threshold loops as its own subTest,
+# so a failure names the iteration it happened on.
+SUBTEST_QUERIES = os.environ.get('PYTEST_VERBOSE', '') not in ('', '0')
+
+# Frozen wall clock the time based tests start from.
+START_TIME = time.mktime(datetime(2011, 6, 21).timetuple())
 
 
 class MockTime(object):
-    """Used to patch into FlaskSqlaDebug's time.time() calls."""
+    """Used to patch into FlaskSqlaDebug's time.time() calls.
+
+    Patched in place of the module's reference to the time module so that only
+    FlaskSqlaDebug sees the mock clock, not logging or SQLAlchemy.
+    """
+
+    __slots__ = ('curr_time', '_time_step', '_iter')
 
     def __init__(self, start_time=0, time_step=0):
         """Init with the start time and time step we will be using."""
         self.curr_time = start_time
         self.time_step = time_step
 
+    @property
+    def time_step(self):
+        """Amount the clock advances on each call."""
+        return self._time_step
+
+    @time_step.setter
+    def time_step(self, value):
+        """Restart the underlying counter from the current time with the new step."""
+        self._time_step = value
+        self._iter = itertools.count(self.curr_time + value, value)
+
     def __call__(self):
         """Be a callable so we can be called like time.time().
 
@@ -34,10 +77,12 @@ class MockTime(object):
         according to time_step's value, either postive or negative.
         """
         rv = self.curr_time
-        # log.debug("returning time: {}".format(rv))
-        self.curr_time += self.time_step
+        self.curr_time = next(self._iter)
         return rv
 
+    # Stand in for the time module: time.time() advances the clock.
+    time = __call__
+
     def get_time(self):
         """Get the current time without adjusting it."""
         return self.curr_time
@@ -51,12 +96,16 @@ class LogCounter(object):
     of calls to log.debug, log.warn, log... etc.
     """
 
+    __slots__ = ('_total', 'warns', 'errors', 'infos', 'debugs', 'echo')
+
     def __init__(self, debug=False):
-        """Set all the counters to zero."""
+        """Set all the counters to zero, if debug is set also pass the messages on to our log."""
         self._reset()
-        self.debug = debug
+        # Not named 'debug', that would shadow the debug() mock.
+        self.echo = debug
 
     def _reset(self):
+        self._total = 0
         self.warns = 0
         self.errors = 0
         self.infos = 0
@@ -64,40 +113,65 @@ class LogCounter(object):
 
     def warn(self, *args, **kwargs):
         """Mock log.warn."""
+        self._total += 1
         self.warns += 1
-        if self.debug:
+        if self.echo:
             log.warn(*args, **kwargs)
 
     def error(self, *args, **kwargs):
         """Mock log.error."""
+        self._total += 1
         self.errors += 1
-        if self.debug:
+        if self.echo:
             log.error(*args, **kwargs)
 
     def info(self, *args, **kwargs):
         """Mock log.info."""
+        self._total += 1
         self.infos += 1
-        if self.debug:
+        if self.echo:
             log.info(*args, **kwargs)
 
     def debug(self, *args, **kwargs):
         """Mock log.debug."""
+        self._total += 1
         self.debugs += 1
-        if self.debug:
+        if self.echo:
             log.debug(*args, **kwargs)
 
     def total_calls(self):
         """Return total number of calls to logging mocks."""
-        return self.warns + self.errors + self.infos + self.debugs
+        return self._total
 
 
 def get_app():
-    """Create a flask object and set it up for testing."""
+    """Return the flask object used for testing, building it on first use."""
+    return _build_app()
+
+
+@functools.lru_cache(maxsize=None)
+def _build_app():
+    """Create a flask object with its db and models and set it up for testing.
+
+    Cached so the Flask/SQLAlchemy wiring and model mapping happen once per process;
+    callers own creating and dropping the schema.
+    """
     app = Flask(__name__)
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-    db = SQLAlchemy(app)
+    app.config['SQLALCHEMY_ECHO'] = False
+    app.config['FLASK_SQLA_DEBUG_MAX_QUERY_COUNT'] = 10
+    # Flask-SQLAlchemy already does this for sqlite://, spelled out so the single shared
+    # in-memory connection the tests depend on is visible here.
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False},
+    }
+    # The tests only read after seeding, so there is never anything to autoflush.
+    db = SQLAlchemy(app, session_options={'autoflush': False})
     app.db = db
+    app.models = dict()
+    app.models["User"] = _create_user_model(db)
     return app
 
 
@@ -118,31 +192,53 @@ def _create_user_model(db):
     return User
 
 
+def _seed_users(db, user_model, count):
+    """Bulk insert users with primary keys 0..count-1 so lookups in the tests find real rows."""
+    db.session.bulk_insert_mappings(user_model, [
+        dict(id=i, username="user%d" % i, email="user%d@example.com" % i) for i in range(count)
+    ])
+    db.session.commit()
+
+
 class FlaskrTestCase(unittest.TestCase):
     """Tests for the FlaskSqlaDebug object."""
 
+    @classmethod
+    def setUpClass(cls):
+        """Create the schema once for the whole test case."""
+        flask_app = get_app()
+        cls.app = flask_app
+        cls.models = flask_app.models
+        flask_app.db.create_all()
+        _seed_users(flask_app.db, cls.models["User"], flask_app.config['FLASK_SQLA_DEBUG_MAX_QUERY_COUNT'] + 1)
+
+    @classmethod
+    def tearDownClass(cls):
+        """Drop the schema built in setUpClass."""
+        cls.app.db.session.remove()
+        cls.app.db.drop_all()
+
     def setUp(self):
-        """Create our flask object and setup for tests.
+        """Set up per-test state.
 
         We create the FlaskSqlaDebug() object here and wire it up with a mock logger.
         """
-        flask_app = get_app()
+        flask_app = self.app
         self.log_catcher = LogCounter()
-        self.app = flask_app
         flask_app.flask_sql_debug = FlaskSqlaDebug(
             app=flask_app, engine=flask_app.db.engine, config=flask_app.config, logger=self.log_catcher
         )
-        self.models = dict()
-        self.models["User"] = _create_user_model(flask_app.db)
-        flask_app.db.create_all()
-        flask_app.models = self.models
-        self.client = self.app.test_client()
 
-    """
     def tearDown(self):
-        pass
-        # self.db.drop_all()
-    """
+        """Unhook the FlaskSqlaDebug object from the shared app."""
+        flask_app = self.app
+        flask_app.db.session.remove()
+
+        debug = flask_app.flask_sql_debug
+        event.remove(debug.engine, 'before_cursor_execute', debug._before_cursor_execute)
+        event.remove(debug.engine, 'after_cursor_execute', debug._after_cursor_execute)
+        flask_app.before_request_funcs[None].remove(debug._before_request_handler)
+        flask_app.after_request_funcs[None].remove(debug._after_request_handler)
 
     def assertZero(self, val, msg=None):  # noqa: N802
         """Assert val is zero."""
@@ -152,163 +248,116 @@ class FlaskrTestCase(unittest.TestCase):
         """Assert value not zero."""
         self.assertNotEqual(val, 0, msg=msg)
 
-    def test_max_queries_log(self):
-        """Make sure we get a log when the max queries happen."""
-        app = self.app
-
-        with app.test_request_context('/?name=Peter'):
-            sql_max_query_count = app.flask_sql_debug.sql_max_query_count
-
-            total_calls = self.log_catcher.total_calls()
-            self.assertZero(total_calls)
-            log.debug("total_calls %d", total_calls)
-
-            user_model = app.models["User"]
-            for x in range(sql_max_query_count - 1):
-                user_model.query.get(x)
-            total_calls = self.log_catcher.total_calls()
-            log.debug("total_calls %d", total_calls)
-            self.assertZero(total_calls)
-
-            user_model.query.get(sql_max_query_count)
-            total_calls = self.log_catcher.total_calls()
-            log.debug("total_calls %d", total_calls)
-            self.assertNotZero(total_calls)
-
-    def test_max_queries_exception(self):
-        """Make sure that when configured to do so we get an exception when exceeding max queries."""
-        app = self.app
-
-        with app.test_request_context('/?name=Peter'):
-            # def max_queries():
-            # app = current_app
-            app.flask_sql_debug.throw_exception = True
-            sql_max_query_count = app.flask_sql_debug.sql_max_query_count
-
-            user_model = app.models["User"]
-            for x in range(sql_max_query_count - 1):
-                user_model.query.get(x)
-            with self.assertRaises(Exception):
-                log.debug("Expecting exception")
-                user_model.query.get(sql_max_query_count)
-
-    def test_max_query_time_log(self):
-        """Test that we log when we hit the max queries per request."""
-        start_time = time.mktime(datetime(2011, 6, 21).timetuple())
-        app = self.app
-
-        return_time = MockTime(start_time)
-        app.flask_sql_debug.before_cursor_execute_time = return_time
-        app.flask_sql_debug.after_cursor_execute_time = return_time
-
-        with app.test_request_context('/?name=Peter'):
-            total_calls = self.log_catcher.total_calls()
-            self.assertZero(total_calls)
-
-            max_time = 5.0
-            app.flask_sql_debug.sql_max_total_query_seconds = max_time
-
-            user_model = app.models["User"]
-
-            # should be ok... time is frozen right now.
-            user_model.query.get(0)
-            self.assertZero(self.log_catcher.total_calls())
-
-            total_queries = 0
-            return_time.time_step = 1.0
-            while return_time.get_time() - start_time < max_time:
-                log.debug("Query number: {}".format(total_queries))
-                total_queries += 1
-                user_model.query.get(0)
-
-            self.assertNotZero(self.log_catcher.total_calls())
-            self.assertGreater(total_queries, 2)
-
-    def test_max_query_time_exception(self):
-        """Test that throwing an exception works for when we exceed the max query time."""
-        start_time = time.mktime(datetime(2011, 6, 21).timetuple())
+    def test_max_queries(self):
+        """Make sure we log, or raise when configured to, when the max queries happen."""
         app = self.app
 
-        return_time = MockTime(start_time)
-        app.flask_sql_debug.before_cursor_execute_time = return_time
-        app.flask_sql_debug.after_cursor_execute_time = return_time
-
-        with app.test_request_context('/?name=Peter'):
-            app.flask_sql_debug.throw_exception = True
-
-            total_calls = self.log_catcher.total_calls()
-            self.assertZero(total_calls)
-
-            max_time = 5.0
-            app.flask_sql_debug.sql_max_total_query_seconds = max_time
-
-            user_model = app.models["User"]
-
-            # should be ok... time is frozen right now.
-            user_model.query.get(0)
-            self.assertZero(self.log_catcher.total_calls())
-
-            total_queries = 0
-            return_time.time_step = 1.0
-            with self.assertRaises(Exception):
-                while return_time.get_time() - start_time < max_time:
-                    log.debug("Query number: {}".format(total_queries))
-                    total_queries += 1
-                    user_model.query.get(0)
-
-    def test_single_query_time_log(self):
-        """Test the max time for a single query, make sure we log when exceeded."""
-        start_time = time.mktime(datetime(2011, 6, 21).timetuple())
-        app = self.app
-
-        return_time = MockTime(start_time)
-        app.flask_sql_debug.before_cursor_execute_time = return_time
-        app.flask_sql_debug.after_cursor_execute_time = return_time
-
-        with app.test_request_context('/?name=Peter'):
-
-            total_calls = self.log_catcher.total_calls()
-            self.assertZero(total_calls)
-
-            max_time = 5.0
-            app.flask_sql_debug.sql_max_single_query_seconds = max_time
-
-            user_model = app.models["User"]
-
-            # should be ok... time is almost frozen right now.
-            return_time.time_step = 0.01
-            user_model.query.get(0)
-            self.assertZero(self.log_catcher.total_calls())
-
-            return_time.time_step = float(max_time) + 0.1
-            user_model.query.get(0)
-            self.assertNotZero(self.log_catcher.total_calls())
-
-    def test_single_query_time_exception(self):
-        """Test the max time for a single query, make sure we throw an exception when configured to do so."""
-        start_time = time.mktime(datetime(2011, 6, 21).timetuple())
+        for throw in (False, True):
+            self.log_catcher._reset()
+            with self.subTest(throw=throw), app.test_request_context('/?name=Peter'):
+                app.flask_sql_debug.throw_exception = throw
+                sql_max_query_count = app.flask_sql_debug.sql_max_query_count
+
+                total_calls = self.log_catcher.total_calls()
+                self.assertZero(total_calls)
+                log.debug("total_calls %d", total_calls)
+
+                user_model = app.models["User"]
+                for x in range(sql_max_query_count - 1):
+                    app.db.session.get(user_model, x, populate_existing=True)
+                total_calls = self.log_catcher.total_calls()
+                log.debug("total_calls %d", total_calls)
+                self.assertZero(total_calls)
+
+                if throw:
+                    with self.assertRaises(Exception):
+                        log.debug("Expecting exception")
+                        app.db.session.get(user_model, sql_max_query_count, populate_existing=True)
+                else:
+                    app.db.session.get(user_model, sql_max_query_count, populate_existing=True)
+                    total_calls = self.log_catcher.total_calls()
+                    log.debug("total_calls %d", total_calls)
+                    self.assertNotZero(total_calls)
+
+    @contextlib.contextmanager
+    def _frozen_clock(self):
+        """Freeze FlaskSqlaDebug's clock at START_TIME inside a request context.
+
+        Yields the MockTime and the flask app; tests move the clock by setting time_step.
+        """
         app = self.app
-
-        return_time = MockTime(start_time)
-        app.flask_sql_debug.before_cursor_execute_time = return_time
-        app.flask_sql_debug.after_cursor_execute_time = return_time
-
-        with app.test_request_context('/?name=Peter'):
-            app.flask_sql_debug.throw_exception = True
-
-            max_time = 5.0
-            app.flask_sql_debug.sql_max_single_query_seconds = max_time
-
-            user_model = app.models["User"]
-
-            # should be ok... time is almost frozen right now.
-            return_time.time_step = 0.01
-            user_model.query.get(0)
+        return_time = MockTime(START_TIME)
+        with mock.patch('flask_sqla_debug.time', return_time), app.test_request_context('/?name=Peter'):
             self.assertZero(self.log_catcher.total_calls())
-
-            return_time.time_step = float(max_time) + 0.1
-            with self.assertRaises(Exception):
-                user_model.query.get(0)
+            yield return_time, app
+
+    def _query_step(self, total_queries):
+        """Context for one iteration of a query loop, a subTest only when SUBTEST_QUERIES is set."""
+        if SUBTEST_QUERIES:
+            return self.subTest(i=total_queries)
+        return contextlib.nullcontext()
+
+    def test_max_query_time(self):
+        """Test that we log, or raise when configured to, when we exceed the max total query time."""
+        for throw in (False, True):
+            self.log_catcher._reset()
+            with self.subTest(throw=throw), self._frozen_clock() as (return_time, app):
+                app.flask_sql_debug.throw_exception = throw
+
+                max_time = 5.0
+                app.flask_sql_debug.sql_max_total_query_seconds = max_time
+                # Only the total time should trip, keep each query under the single query limit.
+                app.flask_sql_debug.sql_max_single_query_seconds = max_time
+
+                user_model = app.models["User"]
+
+                # should be ok... time is frozen right now.
+                app.db.session.get(user_model, 0, populate_existing=True)
+                self.assertZero(self.log_catcher.total_calls())
+
+                return_time.time_step = 1.0
+                # Each query takes one time_step, exactly this many push the total past max_time.
+                iters = int(max_time / return_time.time_step) + 1
+                for total_queries in range(1, iters):
+                    with self._query_step(total_queries):
+                        log.debug("Query number: %d", total_queries)
+                        app.db.session.get(user_model, 0, populate_existing=True)
+                self.assertZero(self.log_catcher.total_calls())
+
+                log.debug("Query number: %d", iters)
+                if throw:
+                    with self.assertRaises(Exception):
+                        app.db.session.get(user_model, 0, populate_existing=True)
+                else:
+                    app.db.session.get(user_model, 0, populate_existing=True)
+                    self.assertNotZero(self.log_catcher.total_calls())
+
+    def test_single_query_time(self):
+        """Test the max time for a single query, make sure we log, or raise when configured to, when exceeded."""
+        for throw in (False, True):
+            self.log_catcher._reset()
+            with self.subTest(throw=throw), self._frozen_clock() as (return_time, app):
+                app.flask_sql_debug.throw_exception = throw
+
+                max_time = 5.0
+                app.flask_sql_debug.sql_max_single_query_seconds = max_time
+                # Only the single query time should trip, keep the total well under its limit.
+                app.flask_sql_debug.sql_max_total_query_seconds = max_time * 10
+
+                user_model = app.models["User"]
+
+                # should be ok... time is almost frozen right now.
+                return_time.time_step = 0.01
+                app.db.session.get(user_model, 0, populate_existing=True)
+                self.assertZero(self.log_catcher.total_calls())
+
+                return_time.time_step = float(max_time) + 0.1
+                if throw:
+                    with self.assertRaises(Exception):
+                        app.db.session.get(user_model, 0, populate_existing=True)
+                else:
+                    app.db.session.get(user_model, 0, populate_existing=True)
+                    self.assertNotZero(self.log_catcher.total_calls())
 
 
 if __name__ == '__main__':
@@ -1,15 +0,0 @@
-"""Setup for flask_sqla_debug."""
-
-from distutils.core import setup
-setup(
-    name='flask_sqla_debug',
-    packages=['flask_sqla_debug'],
-    version='0.2',
-    description='Helpers for debugging flask and sqlalchemy performance',
-    author='Alfred Perlstein',
-    author_email='alfred.perlstein@gmail.com',
-    url='https://github.com/splbio/flask_sqla_debug',
-    download_url='https://github.com/splbio/flask_sqla_debug/tarball/0.1',
-    keywords=['testing', 'logging', 'debug', 'flask', 'sqlalchemy'],
-    classifiers=[],
-)